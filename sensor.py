@@ -1,21 +1,38 @@
+import asyncio
 import logging
+import math
+import os
+import random
 import sqlite3
+import time
 import aiohttp
 from homeassistant.components.sensor import SensorEntity, PLATFORM_SCHEMA
 from homeassistant.const import (
+    EVENT_HOMEASSISTANT_STOP,
     PERCENTAGE,
     UnitOfTime,
     UnitOfTemperature,
 )
 
-from homeassistant.core import HomeAssistant
+from homeassistant.core import HomeAssistant, callback
+from homeassistant.exceptions import PlatformNotReady
+from homeassistant.helpers.aiohttp_client import async_get_clientsession
 from homeassistant.helpers.entity import Entity
+from homeassistant.helpers.event import (
+    async_call_later,
+    async_track_state_change_event,
+    async_track_time_interval,
+)
 from homeassistant.helpers.typing import ConfigType, DiscoveryInfoType
 from homeassistant.helpers.entity_platform import AddEntitiesCallback
+from homeassistant.helpers.update_coordinator import CoordinatorEntity, DataUpdateCoordinator
 import homeassistant.helpers.config_validation as cv
 import voluptuous as vol
 import homeassistant.util.dt as dt_util
+from homeassistant.util.json import json_loads
+from collections import deque
 from datetime import datetime, timedelta
+from functools import partial
 
 
 DOMAIN = "ecobee_learning"
@@ -27,19 +44,42 @@ CONF_ENERGY_RATE = "energy_rate"
 CONF_WEATHER_API_KEY = "weather_api_key"
 CONF_ZIP_CODE = "zip_code"
 
+# equipment_running tokens that mean the compressor is cooling
+_COOL_TOKENS = frozenset({'compCool1', 'compCool2'})
+
 _LOGGER = logging.getLogger(__name__)
 
+# Open connections and their locks, keyed by absolute database path
+_CONNECTIONS: dict[str, sqlite3.Connection] = {}
+_DB_LOCKS: dict[str, asyncio.Lock] = {}
+
 DEFAULT_NAME = "Ecobee AC Runtime"
 DEFAULT_DB_PATH = "ecobee_learning.db"
 DEFAULT_ENERGY_RATE = 0.12  # $/kWh
+ALERT_THRESHOLD = 1.5  # alert when a cycle runs this many times the average
+# (threshold, score change) pairs, highest threshold first; the first match applies
+_OUTDOOR_BONUS = ((95, 20), (85, 10))  # outdoor °F
+_EFF_PENALTY = ((30, 30), (20, 20), (10, 10))  # minutes per degree
+ROLLING_WINDOW_SECONDS = 7 * 24 * 3600
+RETENTION_SECONDS = 30 * 24 * 3600  # rows kept on disk; metrics only use the last 7 days
+PRUNE_INTERVAL = timedelta(days=1)
+PRUNE_STARTUP_DELAY = 60  # seconds
+SCAN_INTERVAL = timedelta(seconds=30)
+# Sensors only read coordinator data, so entity updates need no throttling
+PARALLEL_UPDATES = 0
+WEATHER_CACHE_SECONDS = 1800
+WEATHER_RETRY_SECONDS = 300  # back-off after a failed weather lookup
+WEATHER_RETRIES = 3
+WEATHER_RETRY_DELAY = 2.0  # upper bound of the jittered pause between attempts
 
 PLATFORM_SCHEMA = PLATFORM_SCHEMA.extend({
     vol.Optional(CONF_NAME, default=DEFAULT_NAME): cv.string,
     vol.Required(CONF_CLIMATE_ENTITY): cv.entity_id,
     vol.Optional(CONF_DB_PATH, default=DEFAULT_DB_PATH): cv.string,
     vol.Optional(CONF_ENERGY_RATE, default=DEFAULT_ENERGY_RATE): cv.positive_float,
-    vol.Required(CONF_WEATHER_API_KEY): cv.string,
-    vol.Required(CONF_ZIP_CODE): cv.string,
+    # Outdoor temperature needs both, so reject a half-configured pair
+    vol.Inclusive(CONF_WEATHER_API_KEY, "weather"): cv.string,
+    vol.Inclusive(CONF_ZIP_CODE, "weather"): cv.string,
 })
 
 
@@ -55,32 +95,86 @@ async def async_setup_platform(
     climate_entity = config[CONF_CLIMATE_ENTITY]
     db_path = config.get(CONF_DB_PATH)
     energy_rate = config.get(CONF_ENERGY_RATE)
-    weather_api_key = config[CONF_WEATHER_API_KEY]
-    zip_code = config[CONF_ZIP_CODE]
+    weather_api_key = config.get(CONF_WEATHER_API_KEY)
+    zip_code = config.get(CONF_ZIP_CODE)
 
 
     data = EcobeeLearningData(hass, climate_entity, db_path, energy_rate, weather_api_key, zip_code)
-    await data.async_update()
+    if not _CONNECTIONS:
+        # Connections outlive the instances that opened them, so release them on shutdown
+        hass.bus.async_listen_once(
+            EVENT_HOMEASSISTANT_STOP, partial(_async_close_connections, hass)
+        )
+    await data.async_init()
+    coordinator = EcobeeLearningCoordinator(hass, data)
+    await coordinator.async_refresh()
+    if not coordinator.last_update_success:
+        # Sensors need the first refresh's data; let HA retry the platform later
+        raise PlatformNotReady(f"Initial update for {climate_entity} failed")
+    coordinator.async_start()
+    # The interval first fires a day after setup, so also prune soon after
+    # startup for installs that restart more often than that
+    async_call_later(hass, PRUNE_STARTUP_DELAY, data.async_prune)
+    async_track_time_interval(hass, data.async_prune, PRUNE_INTERVAL)
 
     sensors = [
-        EcobeeRuntimeSensor(f"{name} Current Runtime", "current_runtime", data),
-        EcobeeRuntimeSensor(f"{name} Average Runtime", "average_runtime", data),
-        EcobeeTemperatureSensor(f"{name} Current Temperature", "current_temp", data),
-        EcobeeTemperatureSensor(f"{name} Target Temperature", "target_temp", data),
-        EcobeeStateSensor(f"{name} HVAC Action", "hvac_action", data),
-        EcobeeStateSensor(f"{name} Equipment Running", "equipment_running", data),
-        EcobeeBooleanSensor(f"{name} Alert", "alert", data),
-        EcobeeRuntimeSensor(f"{name} Avg Time per Degree", "avg_time_per_degree", data),
-        EcobeeEfficiencySensor(f"{name} Energy Efficiency Score", "efficiency_score", data),
-        EcobeeCostSensor(f"{name} Estimated Daily Cost", "estimated_daily_cost", data),
-        EcobeeTemperatureSensor(f"{name} Outdoor Temperature", "outdoor_temp", data),
+        EcobeeSensor(f"{name} Current Runtime", "current_runtime", coordinator, UnitOfTime.MINUTES, 2),
+        EcobeeSensor(f"{name} Average Runtime", "average_runtime", coordinator, UnitOfTime.MINUTES, 2),
+        EcobeeSensor(f"{name} Current Temperature", "current_temp", coordinator, UnitOfTemperature.FAHRENHEIT),
+        EcobeeSensor(f"{name} Target Temperature", "target_temp", coordinator, UnitOfTemperature.FAHRENHEIT),
+        EcobeeSensor(f"{name} HVAC Action", "hvac_action", coordinator),
+        EcobeeSensor(f"{name} Equipment Running", "equipment_running", coordinator),
+        EcobeeAlertSensor(f"{name} Alert", "alert", coordinator),
+        EcobeeSensor(f"{name} Avg Time per Degree", "avg_time_per_degree", coordinator, UnitOfTime.MINUTES, 2),
+        EcobeeSensor(f"{name} Energy Efficiency Score", "efficiency_score", coordinator, PERCENTAGE),
+        EcobeeSensor(f"{name} Estimated Daily Cost", "estimated_daily_cost", coordinator, "$", 2),
+        EcobeeSensor(f"{name} Outdoor Temperature", "outdoor_temp", coordinator, UnitOfTemperature.FAHRENHEIT),
     ]
 
-    async_add_entities(sensors, True)
+    async_add_entities(sensors)
+
+async def _async_close_connections(hass, event):
+    """Close the shared database connections when Home Assistant stops."""
+    for key in list(_CONNECTIONS):
+        async with _DB_LOCKS[key]:
+            conn = _CONNECTIONS.pop(key, None)
+            if conn is not None:
+                await hass.async_add_executor_job(conn.close)
 
 class EcobeeLearningData:
     """Manage Ecobee data and historical storage."""
 
+    # Fixed statement text lets sqlite3 reuse its prepared statements
+    SQL_INSERT_RUNTIME = (
+        "INSERT INTO runtime_data "
+        "(timestamp, ts_epoch, climate_entity, runtime, temp_change, current_temp, outdoor_temp) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?)"
+    )
+    SQL_PRAGMAS = (
+        # Only takes effect on new databases; lets pruning hand pages back
+        "PRAGMA auto_vacuum=INCREMENTAL;"
+        "PRAGMA journal_mode=WAL;"
+        "PRAGMA synchronous=NORMAL;"
+        "PRAGMA temp_store=MEMORY;"
+        "PRAGMA cache_size=-8000;"
+    )
+    SQL_PRUNE = "DELETE FROM runtime_data WHERE ts_epoch < ?"
+    SQL_SELECT_WINDOW = (
+        "SELECT ts_epoch, runtime, temp_change FROM runtime_data "
+        # Rows stored before cycles were tagged can't be attributed, so every
+        # thermostat on the database keeps counting them until they age out
+        "WHERE ts_epoch > ? AND (climate_entity = ? OR climate_entity IS NULL) ORDER BY ts_epoch"
+    )
+
+    __slots__ = (
+        "hass", "climate_entity", "db_path", "energy_rate", "weather_api_key", "zip_code",
+        "conn", "_weather_url", "_session", "_http_timeout", "_weather_cache", "_weather_expires",
+        "_weather_lock", "_weather_refresh_task", "data", "cooling_start_monotonic",
+        "cooling_start_temp", "_last_climate_state", "_is_cooling", "_published_metrics",
+        "_update_lock", "_alert_cutoff", "_db_key", "_db_lock", "_window", "_sum_runtime",
+        "_sum_efficiency", "_count_efficiency", "_sum_rate", "_count_rate", "_metrics",
+    )
+
     def __init__(self, hass, climate_entity, db_path, energy_rate, weather_api_key, zip_code):
         """Initialize the data object."""
         self.hass = hass
@@ -89,283 +183,411 @@ class EcobeeLearningData:
         self.energy_rate = energy_rate or DEFAULT_ENERGY_RATE
         self.weather_api_key = weather_api_key
         self.zip_code = zip_code
-        self.conn = sqlite3.connect(self.db_path)
-        self.create_table()
+        self.conn = None
+        # Only users with outdoor temperature configured need a URL and HTTP session
+        if weather_api_key and zip_code:
+            self._weather_url = f"https://api.weatherapi.com/v1/current.json?key={weather_api_key}&q={zip_code}"
+            self._session = async_get_clientsession(hass)
+        else:
+            self._weather_url = None
+            self._session = None
+        self._http_timeout = aiohttp.ClientTimeout(total=4.0)
+        self._weather_cache = {}
+        self._weather_expires = 0.0
+        self._weather_lock = asyncio.Lock()
+        self._weather_refresh_task = None
         self.data = {}
-        self.cooling_start_time = None
+        self.cooling_start_monotonic = None
         self.cooling_start_temp = None
-
+        self._last_climate_state = None
+        self._is_cooling = False
+        self._published_metrics = None
+        self._update_lock = asyncio.Lock()
+        self._alert_cutoff = math.inf
+        # Thermostats configured with the same db_path share one connection and lock
+        self._db_key = os.path.abspath(self.db_path)
+        self._db_lock = _DB_LOCKS.setdefault(self._db_key, asyncio.Lock())
+        # Rolling 7-day window of (epoch seconds, runtime, minutes_per_degree, rate)
+        self._window = deque()
+        self._sum_runtime = 0.0
+        self._sum_efficiency = 0.0
+        self._count_efficiency = 0
+        self._sum_rate = 0.0
+        self._count_rate = 0
+        self._metrics = None
+
+    async def async_init(self):
+        """Open the database and load the rolling window without blocking the loop."""
+        await self._async_run_db(self.open_db)
+        rows = await self._async_run_db(self.fetch_window_rows)
+        for ts_epoch, runtime, temp_change in rows:
+            self.add_to_window(ts_epoch, runtime, temp_change)
+
+    async def _async_run_db(self, func, *args):
+        """Run a blocking database call in the executor, one at a time."""
+        async with self._db_lock:
+            return await self.hass.async_add_executor_job(func, *args)
+
+    def open_db(self):
+        """Connect to the database and make sure the schema exists."""
+        key = self._db_key
+        if key in _CONNECTIONS:
+            self.conn = _CONNECTIONS[key]
+            return
+        # Calls are serialized by _db_lock but may land on any executor thread
+        self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        try:
+            # WAL with NORMAL sync only fsyncs at checkpoints instead of every commit;
+            # cache_size is in KiB when negative
+            self.conn.executescript(self.SQL_PRAGMAS)
+            try:
+                self.conn.execute("PRAGMA mmap_size=67108864")
+            except sqlite3.Error as e:
+                # Some supervised installs don't allow memory-mapped I/O
+                _LOGGER.debug(f"Memory-mapped I/O not available: {e}")
+            self.create_table()
+        except Exception:
+            self.conn.close()
+            self.conn = None
+            raise
+        # Only share the connection once its schema is known to be in place
+        _CONNECTIONS[key] = self.conn
 
     def create_table(self):
         """Create the database tables if they don't exist."""
         cursor = self.conn.cursor()
         cursor.execute('''
         CREATE TABLE IF NOT EXISTS runtime_data
-        (timestamp TEXT, runtime REAL, temp_change REAL, current_temp REAL, outdoor_temp REAL)
+        (timestamp TEXT, runtime REAL, temp_change REAL, current_temp REAL, outdoor_temp REAL,
+         ts_epoch INTEGER, climate_entity TEXT)
         ''')
+        # The change rate is derived from runtime and temp_change when cycles
+        # enter the rolling window, so the old second table is no longer written
+        cursor.execute("DROP TABLE IF EXISTS temp_change_rate")
+        columns = {row[1] for row in cursor.execute("PRAGMA table_info(runtime_data)")}
+        if 'ts_epoch' not in columns:
+            # Range scans compare fixed-width integers instead of ISO strings;
+            # the text timestamps are local time, hence the 'utc' conversion
+            cursor.execute("ALTER TABLE runtime_data ADD COLUMN ts_epoch INTEGER")
+            cursor.execute("UPDATE runtime_data SET ts_epoch = CAST(strftime('%s', timestamp, 'utc') AS INTEGER)")
+        if 'climate_entity' not in columns:
+            # Thermostats sharing a db_path each average only their own cycles
+            cursor.execute("ALTER TABLE runtime_data ADD COLUMN climate_entity TEXT")
+        # Covers the window query so it is answered from the index alone
         cursor.execute('''
-        CREATE TABLE IF NOT EXISTS temp_change_rate
-        (timestamp TEXT, rate REAL)
+        CREATE INDEX IF NOT EXISTS idx_runtime_epoch_cover
+        ON runtime_data (ts_epoch, climate_entity, runtime, temp_change)
         ''')
         self.conn.commit()
+        # Refresh planner statistics where they are missing or stale
+        cursor.execute("PRAGMA optimize")
 
     async def async_update(self):
+        """Refresh the data, one refresh at a time."""
+        async with self._update_lock:
+            await self._async_update()
+
+    async def _async_update(self):
         """Update data from Home Assistant climate entity and external sources."""
         climate_state = self.hass.states.get(self.climate_entity)
 
         if climate_state:
-            self.data['current_temp'] = climate_state.attributes.get('current_temperature')
-            self.data['target_temp'] = climate_state.attributes.get('temperature')
-            self.data['hvac_action'] = climate_state.attributes.get('hvac_action')
-            self.data['equipment_running'] = climate_state.attributes.get('equipment_running')
-
-            if 'compCool' in self.data.get('equipment_running', '') and self.cooling_start_time is None:
-                self.cooling_start_time = datetime.now()
-                self.cooling_start_temp = self.data['current_temp']
-            elif 'compCool' not in self.data.get('equipment_running', '') and self.cooling_start_time is not None:
-                runtime = (datetime.now() - self.cooling_start_time).total_seconds() / 60
-                temp_change = self.cooling_start_temp - self.data['current_temp']
-                outdoor_temp = await self.get_outdoor_temperature()
-                self.store_data(runtime, temp_change, self.data['current_temp'], outdoor_temp)
-                self.cooling_start_time = None
+            # Served from cache; a stale value triggers a background refresh
+            outdoor_temp = await self.get_outdoor_temperature()
+            attrs = climate_state.attributes
+            current_temp = attrs.get('current_temperature')
+            equipment_running = attrs.get('equipment_running')
+            # HA replaces the State object on every change, so an unchanged
+            # object means the cooling check would give the same answer
+            unchanged = climate_state is self._last_climate_state
+            if not unchanged:
+                self._last_climate_state = climate_state
+                self._is_cooling = not _COOL_TOKENS.isdisjoint((equipment_running or '').split(','))
+            is_cooling = self._is_cooling
+            now = self.hass.loop.time()
+
+            start = self.cooling_start_monotonic
+            if is_cooling and start is None:
+                self.cooling_start_monotonic = start = now
+                self.cooling_start_temp = current_temp
+            elif not is_cooling and start is not None:
+                runtime = (now - start) / 60.0
+                temp_change = self.cooling_start_temp - current_temp
+                await self.async_store_data(runtime, temp_change, current_temp, outdoor_temp)
+                self.cooling_start_monotonic = start = None
                 self.cooling_start_temp = None
 
-            # Update current runtime
-            if self.cooling_start_time:
-                self.data['current_runtime'] = (datetime.now() - self.cooling_start_time).total_seconds() / 60
-            else:
-                self.data['current_runtime'] = 0
+            metrics = self.get_metrics()
+            # Idle with nothing new to publish: every value below is already current
+            if (unchanged and start is None and metrics is self._published_metrics
+                    and outdoor_temp == self.data.get('outdoor_temp')):
+                return
+            self._published_metrics = metrics
+
+            # Durations use the loop's monotonic clock so DST changes and NTP
+            # adjustments can't skew them
+            self.data.update({
+                'outdoor_temp': outdoor_temp,
+                'current_temp': current_temp,
+                'target_temp': attrs.get('temperature'),
+                'hvac_action': attrs.get('hvac_action'),
+                'equipment_running': equipment_running,
+                'current_runtime': (now - start) / 60.0 if start is not None else 0,
+            })
 
             # Update calculated fields
-            self.data['average_runtime'] = self.get_average_runtime()
+            average_runtime = metrics['average_runtime']
+            self.data['average_runtime'] = average_runtime
+            # No history means nothing to compare against, so never alert
+            self._alert_cutoff = average_runtime * ALERT_THRESHOLD if average_runtime else math.inf
             self.data['alert'] = self.check_for_alert()
-            self.data['avg_time_per_degree'] = self.get_avg_temp_change_rate()
-            self.data['efficiency_score'] = self.calculate_efficiency_score()
+            self.data['avg_time_per_degree'] = metrics['avg_time_per_degree']
+            self.data['efficiency_score'] = self.calculate_efficiency_score(metrics['minutes_per_degree'])
             self.data['estimated_daily_cost'] = self.estimate_daily_cost()
-            self.data['outdoor_temp'] = await self.get_outdoor_temperature()
 
+    async def async_store_data(self, runtime, temp_change, current_temp, outdoor_temp):
+        """Persist a completed cooling cycle and add it to the rolling window."""
+        now = time.time()
+        if await self._async_run_db(self.store_data, now, runtime, temp_change, current_temp, outdoor_temp):
+            self.add_to_window(now, float(runtime), float(temp_change))
 
-    def store_data(self, runtime, temp_change, current_temp, outdoor_temp):
+    def store_data(self, now, runtime, temp_change, current_temp, outdoor_temp):
         """Store the runtime data in the database."""
+        if not self.connection_open():
+            return False
         try:
-            cursor = self.conn.cursor()
-            cursor.execute('''
-            INSERT INTO runtime_data (timestamp, runtime, temp_change, current_temp, outdoor_temp)
-            VALUES (?, ?, ?, ?, ?)
-            ''', (datetime.now().isoformat(), float(runtime), float(temp_change), float(current_temp), float(outdoor_temp)))
-            self.conn.commit()
-
-            # Calculate and store the rate of temperature change
-            if runtime > 0 and temp_change != 0:
-                rate = abs(runtime / temp_change)  # minutes per degree
-                cursor.execute('''
-                INSERT INTO temp_change_rate (timestamp, rate)
-                VALUES (?, ?)
-                ''', (datetime.now().isoformat(), rate))
-                self.conn.commit()
+            # Outdoor temperature is optional and stays NULL when unavailable
+            outdoor_temp = float(outdoor_temp) if outdoor_temp is not None else None
+            with self.conn:
+                self.conn.execute(self.SQL_INSERT_RUNTIME, (datetime.fromtimestamp(now).isoformat(), int(now), self.climate_entity, float(runtime), float(temp_change), float(current_temp), outdoor_temp))
+            return True
         except Exception as e:
             _LOGGER.error(f"Error storing data in database: {e}")
+            return False
+
+    def connection_open(self):
+        """Return whether the shared connection is still open, e.g. not closed at shutdown."""
+        return self.conn is not None and _CONNECTIONS.get(self._db_key) is self.conn
 
-    def get_average_runtime(self):
-        """Calculate average runtime from historical data."""
+    def fetch_window_rows(self):
+        """Read this thermostat's rows already stored for the last 7 days."""
+        cutoff = int(time.time() - ROLLING_WINDOW_SECONDS)
         try:
-            cursor = self.conn.cursor()
-            cursor.execute('''
-            SELECT AVG(runtime) FROM runtime_data
-            WHERE timestamp > datetime('now', '-7 days')
-            ''')
-            result = cursor.fetchone()
-            return round(result[0], 2) if result and result[0] is not None else None
+            return self.conn.execute(self.SQL_SELECT_WINDOW, (cutoff, self.climate_entity)).fetchall()
         except Exception as e:
-            _LOGGER.error(f"Error calculating average runtime: {e}")
-            return None
+            _LOGGER.error(f"Error loading historical data: {e}")
+            return []
+
+    async def async_prune(self, now=None):
+        """Drop stored cycles older than the retention period."""
+        await self._async_run_db(self.prune)
+
+    def prune(self):
+        """Delete old rows and return the freed pages to the filesystem."""
+        if not self.connection_open():
+            return
+        cutoff = int(time.time() - RETENTION_SECONDS)
+        try:
+            with self.conn:
+                self.conn.execute(self.SQL_PRUNE, (cutoff,))
+            # execute() stops after the first freed page; executescript runs it to completion
+            self.conn.executescript("PRAGMA incremental_vacuum;")
+        except Exception as e:
+            _LOGGER.error(f"Error pruning old data: {e}")
+
+    def add_to_window(self, timestamp, runtime, temp_change):
+        """Add one cooling cycle to the rolling window and its running sums."""
+        minutes_per_degree = runtime / temp_change if temp_change != 0 else None
+        rate = abs(runtime / temp_change) if runtime > 0 and temp_change != 0 else None
+        self._window.append((timestamp, runtime, minutes_per_degree, rate))
+        self._metrics = None
+        self._sum_runtime += runtime
+        if minutes_per_degree is not None:
+            self._sum_efficiency += minutes_per_degree
+            self._count_efficiency += 1
+        if rate is not None:
+            self._sum_rate += rate
+            self._count_rate += 1
+
+    def evict_expired(self):
+        """Drop cycles older than the rolling window from the running sums."""
+        window = self._window
+        cutoff = time.time() - ROLLING_WINDOW_SECONDS
+        if not window or window[0][0] > cutoff:
+            return
+        self._metrics = None
+        while window and window[0][0] <= cutoff:
+            _, runtime, minutes_per_degree, rate = window.popleft()
+            self._sum_runtime -= runtime
+            if minutes_per_degree is not None:
+                self._sum_efficiency -= minutes_per_degree
+                self._count_efficiency -= 1
+            if rate is not None:
+                self._sum_rate -= rate
+                self._count_rate -= 1
+        if not window:
+            # Reset so floating point drift can't accumulate across empty periods
+            self._sum_runtime = self._sum_efficiency = self._sum_rate = 0.0
+
+    def get_metrics(self):
+        """Return the 7-day runtime aggregates from the rolling window."""
+        self.evict_expired()
+        # Only recomputed after a cycle was added or aged out
+        if self._metrics is not None:
+            return self._metrics
+        count = len(self._window)
+        average_runtime = self._sum_runtime / count if count else None
+        minutes_per_degree = self._sum_efficiency / self._count_efficiency if self._count_efficiency else None
+        avg_rate = self._sum_rate / self._count_rate if self._count_rate else None
+        self._metrics = {
+            'average_runtime': average_runtime,
+            'minutes_per_degree': minutes_per_degree,
+            'avg_time_per_degree': avg_rate,
+        }
+        return self._metrics
 
     def check_for_alert(self):
         """Check if current runtime exceeds 1.5 times the average."""
-        if self.data['current_runtime'] and self.data['average_runtime']:
-            return self.data['current_runtime'] > self.data['average_runtime'] * 1.5
-        return False
+        return self.data['current_runtime'] > self._alert_cutoff
 
-    def get_avg_temp_change_rate(self):
-        """Retrieve the average temperature change rate from the database."""
-        try:
-            cursor = self.conn.cursor()
-            cursor.execute('''
-            SELECT AVG(rate) FROM temp_change_rate
-            WHERE timestamp > datetime('now', '-7 days')
-            ''')
-            result = cursor.fetchone()
-            return round(result[0], 2) if result and result[0] is not None else None
-        except Exception as e:
-            _LOGGER.error(f"Error retrieving average temperature change rate: {e}")
+    def calculate_efficiency_score(self, efficiency):
+        """Calculate efficiency score from the average minutes needed per degree."""
+        if efficiency is None:
             return None
 
-    def calculate_efficiency_score(self):
-        """Calculate efficiency score based on runtime and temperature change rate."""
-        try:
-            # Get average runtime and temp change rate for the last week
-            cursor = self.conn.cursor()
-            cursor.execute('''
-            SELECT AVG(runtime/temp_change) as efficiency
-            FROM runtime_data 
-            WHERE timestamp > datetime('now', '-7 days')
-            AND temp_change != 0
-            ''')
-            result = cursor.fetchone()
-            
-            if result[0] is None:
-                return None
-                
-            # Lower minutes per degree is more efficient
-            base_score = 100
-            efficiency = result[0]  # minutes per degree
-            
-            # Adjust score based on outdoor temperature impact
-            if self.data.get('outdoor_temp'):
-                outdoor_temp = self.data['outdoor_temp']
-                # Harder to cool when it's hotter outside, so adjust score up
-                if outdoor_temp > 85:
-                    base_score += 10
-                elif outdoor_temp > 95:
-                    base_score += 20
-            
-            # Penalize score based on efficiency (higher minutes per degree)
-            if efficiency > 30:  # Takes more than 30 mins per degree
-                base_score -= 30
-            elif efficiency > 20:
-                base_score -= 20
-            elif efficiency > 10:
-                base_score -= 10
-                
-            return max(0, min(100, base_score))  # Keep score between 0-100
-            
-        except Exception as e:
-            _LOGGER.error(f"Error calculating efficiency score: {e}")
-            return None
+        # Lower minutes per degree is more efficient
+        base_score = 100
+
+        # Adjust score based on outdoor temperature impact
+        if self.data.get('outdoor_temp'):
+            outdoor_temp = self.data['outdoor_temp']
+            # Harder to cool when it's hotter outside, so adjust score up
+            for threshold, bonus in _OUTDOOR_BONUS:
+                if outdoor_temp > threshold:
+                    base_score += bonus
+                    break
+
+        # Penalize score based on efficiency (higher minutes per degree)
+        for threshold, penalty in _EFF_PENALTY:
+            if efficiency > threshold:
+                base_score -= penalty
+                break
+
+        return max(0, min(100, base_score))  # Keep score between 0-100
 
     def estimate_daily_cost(self):
 
         """Estimate daily energy cost based on runtime and energy rate."""
         if self.data['average_runtime']:
             daily_runtime = self.data['average_runtime'] * 24  # Assuming similar runtime over 24 hours
-            return round(daily_runtime * self.energy_rate / 1000, 2)  # kWh cost
+            return daily_runtime * self.energy_rate / 1000  # kWh cost
         return None
 
     async def get_outdoor_temperature(self):
-        """Get the current outdoor temperature using the provided ZIP code."""
-        if self.weather_api_key and self.zip_code:
-            url = f"http://api.weatherapi.com/v1/current.json?key={self.weather_api_key}&q={self.zip_code}"
-            try:
-                async with aiohttp.ClientSession() as session:
-                    async with session.get(url) as response:
-                        response.raise_for_status()
-                        data = await response.json()
-                        return data['current']['temp_f']
-            except Exception as e:
-                _LOGGER.error(f"Error retrieving outdoor temperature: {e}")
-
-                return None
-        return None
-
-class EcobeeRuntimeSensor(SensorEntity):
-    """Representation of an Ecobee Runtime Sensor."""
-
-    _attr_unit_of_measurement = UnitOfTime.MINUTES
-
-    def __init__(self, name, data_key, data):
-        """Initialize the sensor."""
-        self._attr_name = name
-        self.data_key = data_key
-        self.data = data
-
-    async def async_update(self):
-        """Update the sensor."""
-        await self.data.async_update()
-        self._attr_state = self.data.data.get(self.data_key)
-
-class EcobeeTemperatureSensor(SensorEntity):
-    """Representation of an Ecobee Temperature Sensor."""
-
-    _attr_unit_of_measurement = UnitOfTemperature.FAHRENHEIT
-
-    def __init__(self, name, data_key, data):
-        """Initialize the sensor."""
-        self._attr_name = name
-        self.data_key = data_key
-        self.data = data
-
-    async def async_update(self):
-        """Update the sensor."""
-        await self.data.async_update()
-        self._attr_state = self.data.data.get(self.data_key)
-
-class EcobeeStateSensor(SensorEntity):
-    """Representation of an Ecobee State Sensor."""
-
-    def __init__(self, name, data_key, data):
-        """Initialize the sensor."""
-        self._attr_name = name
-        self.data_key = data_key
-        self.data = data
-
-    async def async_update(self):
-        """Update the sensor."""
-        await self.data.async_update()
-        self._attr_state = self.data.data.get(self.data_key)
-
-class EcobeeBooleanSensor(SensorEntity):
-    """Representation of an Ecobee Boolean Sensor."""
-
-    def __init__(self, name, data_key, data):
-        """Initialize the sensor."""
-        self._attr_name = name
-        self.data_key = data_key
-        self.data = data
-
-    async def async_update(self):
-        """Update the sensor."""
-        await self.data.async_update()
-        self._attr_state = self.data.data.get(self.data_key)
-        self._attr_icon = "mdi:alert" if self._attr_state else "mdi:check"
-
-class EcobeeEfficiencySensor(SensorEntity):
-    """Representation of an Ecobee Efficiency Sensor."""
-
-    _attr_unit_of_measurement = PERCENTAGE
-
-    def __init__(self, name, data_key, data):
-        """Initialize the sensor."""
-        self._attr_name = name
-        self.data_key = data_key
-        self.data = data
-
-    async def async_update(self):
-        """Update the sensor."""
-        await self.data.async_update()
-        self._attr_state = self.data.data.get(self.data_key)
-
-class EcobeeCostSensor(SensorEntity):
-    """Representation of an Ecobee Cost Sensor."""
-
-    _attr_unit_of_measurement = "$"
+        """Return the cached outdoor temperature, refreshing it in the background when stale."""
+        if self._weather_url is None:
+            return None
 
-    def __init__(self, name, data_key, data):
+        if self.hass.loop.time() >= self._weather_expires and (
+            self._weather_refresh_task is None or self._weather_refresh_task.done()
+        ):
+            # Retries can take several seconds, so don't hold up startup or block_till_done
+            self._weather_refresh_task = self.hass.async_create_background_task(
+                self._refresh_weather(), name=f"{DOMAIN} weather refresh"
+            )
+        return self._weather_cache.get('temp')
+
+    async def _refresh_weather(self):
+        """Fetch the outdoor temperature for the configured ZIP code, retrying with jitter."""
+        async with self._weather_lock:
+            for attempt in range(WEATHER_RETRIES):
+                if attempt:
+                    await asyncio.sleep(random.uniform(0, WEATHER_RETRY_DELAY))
+                try:
+                    async with self._session.get(self._weather_url, timeout=self._http_timeout) as response:
+                        response.raise_for_status()
+                        data = await response.json(loads=json_loads)
+                        self._weather_cache['temp'] = data['current']['temp_f']
+                        self._weather_expires = self.hass.loop.time() + WEATHER_CACHE_SECONDS
+                        return
+                # Error strings from aiohttp include the request URL, which carries the API key
+                except aiohttp.ClientResponseError as e:
+                    error = f"HTTP {e.status}"
+                except asyncio.TimeoutError:
+                    error = "timed out"
+                except Exception as e:
+                    error = type(e).__name__
+                _LOGGER.debug(f"Outdoor temperature attempt {attempt + 1} failed: {error}")
+
+            _LOGGER.warning(f"Could not retrieve outdoor temperature after {WEATHER_RETRIES} attempts: {error}")
+            # Keep serving the last known value and back off instead of retrying every poll
+            self._weather_expires = self.hass.loop.time() + WEATHER_RETRY_SECONDS
+
+class EcobeeLearningCoordinator(DataUpdateCoordinator):
+    """Refresh the shared EcobeeLearningData once for all of its sensors."""
+
+    def __init__(self, hass, ecobee_data):
+        """Initialize the coordinator."""
+        super().__init__(
+            hass,
+            _LOGGER,
+            name=f"{DOMAIN} {ecobee_data.climate_entity}",
+            update_interval=SCAN_INTERVAL,
+        )
+        self.ecobee_data = ecobee_data
+        self._unsub_climate = None
+
+    @callback
+    def async_start(self):
+        """Refresh as soon as the climate entity changes state."""
+        self._unsub_climate = async_track_state_change_event(
+            self.hass, [self.ecobee_data.climate_entity], self._async_climate_changed
+        )
+        self.hass.bus.async_listen_once(EVENT_HOMEASSISTANT_STOP, self._async_stop)
+
+    @callback
+    def _async_stop(self, event):
+        """Stop following the climate entity when Home Assistant stops."""
+        if self._unsub_climate is not None:
+            self._unsub_climate()
+            self._unsub_climate = None
+
+    @callback
+    def _async_climate_changed(self, event):
+        """Request a refresh so cooling cycles start and stop on time."""
+        self.hass.async_create_task(self.async_request_refresh())
+
+    async def _async_update_data(self):
+        """Run one update of the shared data and hand it to the sensors."""
+        await self.ecobee_data.async_update()
+        # Same dict every tick; it is only mutated in place under the update lock
+        return self.ecobee_data.data
+
+class EcobeeSensor(CoordinatorEntity, SensorEntity):
+    """Sensor exposing one value of the shared coordinator data."""
+
+    def __init__(self, name, data_key, coordinator, unit=None, precision=None):
         """Initialize the sensor."""
+        super().__init__(coordinator)
         self._attr_name = name
         self.data_key = data_key
-        self.data = data
-
-    async def async_update(self):
-        """Update the sensor."""
-        await self.data.async_update()
-        self._attr_state = self.data.data.get(self.data_key)
-
-
-
-
-
-
-
+        self._attr_native_unit_of_measurement = unit
+        self._attr_suggested_display_precision = precision
+        self._attr_native_value = coordinator.data.get(data_key)
+
+    @callback
+    def _handle_coordinator_update(self):
+        """Store this sensor's value from the latest refresh."""
+        self._attr_native_value = self.coordinator.data.get(self.data_key)
+        super()._handle_coordinator_update()
+
+class EcobeeAlertSensor(EcobeeSensor):
+    """Representation of the Ecobee runtime alert."""
+
+    @property
+    def icon(self):
+        """Return an icon matching the alert state."""
+        return "mdi:alert" if self.native_value else "mdi:check"
 
 
 